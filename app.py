@@ -1,15 +1,26 @@
 import os
+import functools
+import asyncio
+import math
 import random
+import secrets
 import string
 import re
-import json
+import orjson
 import io
 import base64
-from flask import Flask, render_template, request, redirect, url_for, session, jsonify, flash
+from typing import TypedDict
+import threading
+import time
+from collections import deque
+from cachetools import TTLCache, TLRUCache
+from flask import Flask, render_template, request, redirect, url_for, session, jsonify, flash, Response, stream_with_context
+from flask.json.provider import JSONProvider
 from dotenv import load_dotenv
-from datetime import datetime, timezone
+from datetime import datetime, timezone, timedelta
 
 import google.generativeai as genai
+from google.api_core import exceptions as google_exceptions
 
 # --- Firebase ---
 import firebase_admin
@@ -23,34 +34,39 @@ import stability_sdk.interfaces.gooseai.generation.generation_pb2 as generation
 import cloudinary
 import cloudinary.uploader
 import cloudinary.api
+import cloudinary.utils
 
 # --- VERCEL FIX 1: Load Environment Variables ---
 load_dotenv() 
 
 # --- VERCEL FIX 2: Handle serviceAccountKey.json ---
-service_account_json_string = os.environ.get('FIREBASE_SERVICE_ACCOUNT_JSON')
+# Done on first use rather than at import, so cold starts that never touch
+# Firestore skip it; warm invocations keep reusing the same client.
+@functools.lru_cache(maxsize=1)
+def get_db():
+    service_account_json_string = os.environ.get('FIREBASE_SERVICE_ACCOUNT_JSON')
 
-try:
-    if service_account_json_string:
-        service_account_info = json.loads(service_account_json_string)
-        cred = credentials.Certificate(service_account_info)
-    else:
-        cred = credentials.Certificate('serviceAccountKey.json')
-
-    firebase_admin.initialize_app(cred)
-except FileNotFoundError:
-    print("="*50)
-    print("ERROR: serviceAccountKey.json not found (for local dev).")
-    print("="*50)
-except ValueError as e:
-    print(f"Firebase already initialized? {e}")
-    pass 
-except json.JSONDecodeError:
-    print("="*50)
-    print("ERROR: FIREBASE_SERVICE_ACCOUNT_JSON is not valid JSON.")
-    print("="*50)
-
-db = firestore.client()
+    try:
+        if service_account_json_string:
+            service_account_info = orjson.loads(service_account_json_string)
+            cred = credentials.Certificate(service_account_info)
+        else:
+            cred = credentials.Certificate('serviceAccountKey.json')
+
+        firebase_admin.initialize_app(cred)
+    except FileNotFoundError:
+        print("="*50)
+        print("ERROR: serviceAccountKey.json not found (for local dev).")
+        print("="*50)
+    except ValueError as e:
+        print(f"Firebase already initialized? {e}")
+        pass 
+    except orjson.JSONDecodeError:
+        print("="*50)
+        print("ERROR: FIREBASE_SERVICE_ACCOUNT_JSON is not valid JSON.")
+        print("="*50)
+
+    return firestore.client()
 # --- END OF VERCEL FIXES ---
 
 
@@ -61,24 +77,59 @@ app = Flask(__name__,
            )
 # --- END OF VERCEL FIX ---
 
+# --- orjson for jsonify / request.get_json ---
+class OrjsonProvider(JSONProvider):
+    def dumps(self, obj, **kwargs):
+        return orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS).decode()
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
+app.json = OrjsonProvider(app)
+
 app.secret_key = os.environ.get('FLASK_SECRET_KEY', 'a_very_strong_default_secret_key_12345')
 
 # --- Configure Gemini ---
-api_key = os.environ.get('GEMINI_API_KEY')
-if not api_key:
-    raise ValueError("GEMINI_API_KEY not found. Set it in Vercel Environment Variables.")
-genai.configure(api_key=api_key) 
-model = genai.GenerativeModel('gemini-2.5-flash')
+@functools.lru_cache(maxsize=1)
+def configure_gemini():
+    api_key = os.environ.get('GEMINI_API_KEY')
+    if not api_key:
+        raise ValueError("GEMINI_API_KEY not found. Set it in Vercel Environment Variables.")
+    genai.configure(api_key=api_key)
+
+GEMINI_MODEL_NAME = 'models/gemini-2.5-flash'
+GEMINI_CACHE_TTL = timedelta(hours=1)
+# Gemini 2.5 Flash won't cache content under 1,024 tokens. Estimate with the
+# usual ~4 characters per token instead of paying a count_tokens round trip.
+GEMINI_CACHE_MIN_TOKENS = 1024
+GEMINI_CHARS_PER_TOKEN = 4
+EMBEDDING_MODEL_NAME = 'models/text-embedding-004'
+
+# Gemini's JSON mode guarantees a bare object matching this schema, so the
+# reply can go straight to orjson.loads.
+class GeminiReply(TypedDict):
+    response: str
+    affection_change: int
+
+GEMINI_GENERATION_CONFIG = genai.GenerationConfig(
+    response_mime_type='application/json',
+    response_schema=GeminiReply
+)
+# The prompt asks for a change between -20 and 20; enforce it on our side.
+AFFECTION_CHANGE_LIMIT = 20
 
 # --- Configure Stability AI ---
-stability_api_key = os.environ.get("STABILITY_API_KEY")
-if not stability_api_key:
-    raise ValueError("STABILITY_API_KEY not found. Set it in Vercel Environment Variables.")
-stability_api = StabilityClient.StabilityInference(
-    key=stability_api_key,
-    verbose=True,
-    engine="stable-diffusion-xl-1024-v1-0",
-)
+# Only image generation needs this client, so don't open its channel on import.
+@functools.lru_cache(maxsize=1)
+def get_stability_api():
+    stability_api_key = os.environ.get("STABILITY_API_KEY")
+    if not stability_api_key:
+        raise ValueError("STABILITY_API_KEY not found. Set it in Vercel Environment Variables.")
+    return StabilityClient.StabilityInference(
+        key=stability_api_key,
+        verbose=True,
+        engine="stable-diffusion-xl-1024-v1-0",
+    )
 
 # --- Configure Cloudinary ---
 cloudinary.config( 
@@ -89,14 +140,85 @@ cloudinary.config(
 if not os.environ.get("CLOUDINARY_CLOUD_NAME"):
     raise ValueError("CLOUDINARY_CLOUD_NAME not found. Set it in Vercel Environment Variables.")
 
+# --- Configure Celery ---
+# Only deploys with a broker hand image generation to a worker
+# (`celery -A app.celery worker`). Without one (e.g. a plain Vercel deploy)
+# images are generated inline and Celery is never imported.
+celery_broker_url = os.environ.get("CELERY_BROKER_URL")
+celery = None
+if celery_broker_url:
+    from celery import Celery
+    celery = Celery(__name__, broker=celery_broker_url)
+
+
+# --- Room read cache ---
+# A page load is followed almost immediately by a send, so keep each room
+# around for a couple of seconds and let the POST reuse the GET's read.
+# Every write to a room must call invalidate_room(). That only clears this
+# process, so a cached "not a member" has to be confirmed with fresh=True.
+room_cache = TTLCache(maxsize=1024, ttl=2)
+room_cache_lock = threading.Lock()
+
+def get_room(room_code, fresh=False):
+    if not fresh:
+        with room_cache_lock:
+            room_data = room_cache.get(room_code)
+        if room_data is not None:
+            return room_data
+
+    room_doc = get_db().collection('rooms').document(room_code).get()
+    if not room_doc.exists:
+        return None
+
+    room_data = room_doc.to_dict()
+    with room_cache_lock:
+        room_cache[room_code] = room_data
+    return room_data
+
+def invalidate_room(room_code):
+    with room_cache_lock:
+        room_cache.pop(room_code, None)
+
+# --- Room messages ---
+# Messages live in rooms/<code>/messages rather than in an array on the room
+# document, so a turn only moves the handful of messages it touches.
+RECENT_MESSAGES_LIMIT = 10
+
+def get_recent_messages(room_ref, room_data, limit=RECENT_MESSAGES_LIMIT):
+    # limit_to_last() queries can't be streamed, only fetched with get().
+    query = room_ref.collection('messages').order_by('timestamp').limit_to_last(limit)
+    messages = [message_doc.to_dict() for message_doc in query.get()]
+
+    # Rooms created before the subcollection still carry their history in the
+    # old `messages` array on the room document.
+    legacy_messages = room_data.get('messages')
+    if legacy_messages:
+        messages = sorted(legacy_messages + messages, key=lambda m: m.get('timestamp'))[-limit:]
+    return messages
+
+# `writer` is a WriteBatch or Transaction, so new messages land in the same
+# commit as whatever room update goes with them.
+def queue_messages(writer, room_ref, messages):
+    messages_ref = room_ref.collection('messages')
+    for message in messages:
+        writer.set(messages_ref.document(), message)
+
+def add_messages(room_ref, messages):
+    batch = get_db().batch()
+    queue_messages(batch, room_ref, messages)
+    batch.commit()
 
 # --- Helper Functions (Unchanged) ---
+# 36^4 (~1.7M) codes keeps collisions rare; create_room() relies on
+# Firestore's create() to reject the odd duplicate instead of reading first.
+ROOM_CODE_ALPHABET = string.ascii_uppercase + string.digits
+
 def generate_room_code(length=4):
-    while True:
-        code = ''.join(random.choices(string.digits, k=length))
-        room_ref = db.collection('rooms').document(code)
-        if not room_ref.get().exists:
-            return code
+    return ''.join(random.choices(ROOM_CODE_ALPHABET, k=length))
+
+# Cloudinary public_ids only need entropy, not a Firestore collision check.
+def random_id(length=10):
+    return secrets.token_urlsafe(length)
 
 def get_user_id():
     if 'user_id' not in session:
@@ -106,41 +228,20 @@ def get_user_id():
 def get_nickname():
     return session.get('nickname', 'Anonymous')
 
-# --- build_gemini_prompt (Unchanged) ---
-def build_gemini_prompt(room_data, user_nickname, message_text):
+# --- build_system_prompt ---
+# Everything here is fixed for the lifetime of a room, so it is sent once as
+# the system instruction (and cached by Gemini) instead of with every message.
+def build_system_prompt(room_data):
     prompt_lines = [
         f"You are {room_data['bot_name']}. Your personality is: {room_data['bot_personality']}.",
         f"Your appearance is: {room_data.get('bot_appearance', 'not specified')}",
         "You are in a role-playing game where multiple users are trying to win your affection.",
     ]
-    prompt_lines.append("\nCurrent affection levels:")
-    if not room_data.get('users'):
-        prompt_lines.append("No one is in the room yet.")
-    else:
-        for user_id, data in room_data['users'].items():
-            prompt_lines.append(f"- {data['nickname']}: {data['score']}%")
-
     prompt_lines.append(f"\nThe current scenario: {room_data['start_scenario']}")
-    prompt_lines.append("\nHere is the recent chat history (max 10):")
-    
-    sorted_messages = sorted(room_data.get('messages', []), key=lambda m: m.get('timestamp'))
-    
-    for msg in sorted_messages[-10:]:
-        sender = msg['user']
-        if sender == room_data['bot_name']:
-            sender_display = "You"
-        elif sender == "System":
-            sender_display = "System"
-        else:
-            sender_display = next((data['nickname'] for uid, data in room_data.get('users', {}).items() if uid == sender), sender)
-        
-        prompt_lines.append(f"{sender_display}: {msg['text']}")
-
-    prompt_lines.append(f"\n--- NEW MESSAGE ---")
-    prompt_lines.append(f"{user_nickname}: {message_text}")
     prompt_lines.append("\n--- YOUR TASK ---")
     prompt_lines.append(
-        "Based on this new message, you must do two things:"
+        "Each turn you will get the current affection levels, the recent chat history and a new message."
+        " Based on the new message, you must do two things:"
         f"\n1.  **Respond** in character as {room_data['bot_name']}."
         "\n2.  **Evaluate** the user's message. How much did it change your affection for them?"
         f" The difficulty is {room_data['difficulty']}/10."
@@ -152,29 +253,316 @@ def build_gemini_prompt(room_data, user_nickname, message_text):
     )
     return "\n".join(prompt_lines)
 
-# --- parse_gemini_response (Unchanged) ---
+# create_room stores the rendered system prompt on the room; rooms created
+# before that still get it built on demand.
+def get_static_prompt(room_data):
+    return room_data.get('static_prompt') or build_system_prompt(room_data)
+
+# --- Gemini context cache ---
+def create_gemini_cache(system_prompt):
+    # Short personas (most of them) can't be cached; they fall back to sending
+    # the system instruction each call, without a doomed create() first.
+    if len(system_prompt) < GEMINI_CACHE_MIN_TOKENS * GEMINI_CHARS_PER_TOKEN:
+        return None
+
+    configure_gemini()
+    try:
+        cache = genai.caching.CachedContent.create(
+            model=GEMINI_MODEL_NAME,
+            system_instruction=system_prompt,
+            ttl=GEMINI_CACHE_TTL
+        )
+        return cache
+    except Exception as e:
+        print(f"Gemini context cache not created: {e}")
+        return None
+
+# One model per room per process. Looking the Gemini cache up costs a network
+# round trip, so building the model on every message is wasteful. A Gemini
+# ChatSession wouldn't help here: it resends its whole local history each turn.
+# Each entry is stored as (model, expires_at) and dropped a minute before the
+# CachedContent behind it expires, so a turn never hits a dead cache.
+GEMINI_CACHE_EXPIRY_MARGIN = 60
+room_models = TLRUCache(maxsize=256, ttu=lambda _key, value, _now: value[1], timer=time.time)
+room_models_lock = threading.Lock()
+
+def get_chat_model(room_code, room_data):
+    with room_models_lock:
+        entry = room_models.get(room_code)
+    if entry is None:
+        entry = build_chat_model(room_code, room_data)
+        with room_models_lock:
+            room_models[room_code] = entry
+    return entry[0]
+
+def evict_chat_model(room_code):
+    with room_models_lock:
+        room_models.pop(room_code, None)
+
+def build_chat_model(room_code, room_data):
+    configure_gemini()
+    cache_name = room_data.get('gemini_cache_name')
+    if cache_name:
+        try:
+            cache = genai.caching.CachedContent.get(name=cache_name)
+        except google_exceptions.NotFound:
+            # The cache expired; recreate it and remember the new name on the room.
+            print(f"Gemini cache {cache_name} expired for room {room_code}, recreating.")
+            cache = create_gemini_cache(get_static_prompt(room_data))
+            get_db().collection('rooms').document(room_code).update(
+                {'gemini_cache_name': cache.name if cache else None}
+            )
+            invalidate_room(room_code)
+        if cache:
+            expires_at = cache.expire_time.timestamp() - GEMINI_CACHE_EXPIRY_MARGIN
+            return genai.GenerativeModel.from_cached_content(cached_content=cache), expires_at
+
+    chat_model = genai.GenerativeModel(GEMINI_MODEL_NAME, system_instruction=get_static_prompt(room_data))
+    return chat_model, time.time() + GEMINI_CACHE_TTL.total_seconds()
+
+# --- build_gemini_prompt ---
+def build_gemini_prompt(room_data, recent_messages, user_nickname, message_text):
+    prompt_lines = ["Current affection levels:"]
+    if not room_data.get('users'):
+        prompt_lines.append("No one is in the room yet.")
+    else:
+        for user_id, data in room_data['users'].items():
+            prompt_lines.append(f"- {data['nickname']}: {data['score']}%")
+
+    prompt_lines.append("\nHere is the recent chat history (max 10):")
+    
+    display_names = {uid: data['nickname'] for uid, data in room_data.get('users', {}).items()}
+    display_names |= {room_data['bot_name']: "You", "System": "System"}
+    prompt_lines.extend(
+        f"{display_names.get(msg['user'], msg['user'])}: {msg['text']}" for msg in recent_messages
+    )
+
+    prompt_lines.append(f"\n--- NEW MESSAGE ---")
+    prompt_lines.append(f"{user_nickname}: {message_text}")
+    return "\n".join(prompt_lines)
+
+# --- parse_gemini_response ---
 def parse_gemini_response(text):
     try:
-        match = re.search(r'\{.*\}', text, re.DOTALL)
-        if not match:
-            print(f"Parsing Error: No JSON block found in response. Response was: {text}")
-            return {"response": text, "affection_change": 0}
-        json_text = match.group(0)
-        data = json.loads(json_text)
+        data = orjson.loads(text)
         return {
             "response": data.get("response", "I'm not sure what to say."),
-            "affection_change": int(data.get("affection_change", 0))
+            "affection_change": max(-AFFECTION_CHANGE_LIMIT, min(AFFECTION_CHANGE_LIMIT, int(data.get("affection_change", 0))))
         }
     except Exception as e:
         print(f"Error parsing Gemini response: {e} - Response was: {text}")
         return {"response": text, "affection_change": 0}
 
+# --- Message pre-filter ---
+# Some messages don't deserve a model call at all: near-empty ones, straight
+# repeats and pure insults get a canned reply and cost no tokens. The first
+# check needs nothing but the text, so it runs before any billed call.
+PROFANITY_RE = re.compile(
+    r"^(?:\W*\b(?:fuck|fucks|fucked|fucker|fuckers|fucking|shit|shits|shitty|bitch|bitches"
+    r"|asshole|assholes|bastard|bastards|dick|dicks|dickhead|cunt|cunts|piss|pissed|crap|damn)\b)+\W*$",
+    re.IGNORECASE
+)
+
+def prefilter_message(text):
+    stripped = text.strip()
+    if len(stripped) < 2:
+        return {"response": "...Did you want to say something?", "affection_change": -1}
+    if PROFANITY_RE.match(stripped):
+        return {"response": "Wow. That's not how you win someone over.", "affection_change": -5}
+    return None
+
+def check_repeated_message(text, recent_user_texts):
+    if recent_user_texts and text.strip().lower() == recent_user_texts[-1].strip().lower():
+        return {"response": "You already said that.", "affection_change": 0}
+    return None
+
+# --- Semantic response cache ---
+# Players in a room keep sending near-identical lines ("hi", "how are you?").
+# Each player keeps their recent message embeddings next to the reply Gemini
+# gave, and a close enough match reuses that reply instead of a new generation.
+# Entries are per player so a reply addressed to someone else by name is never
+# served, and a reused reply never moves the score, so rephrasing a compliment
+# can't farm affection. Kept in-process: reading the vectors back from
+# Firestore would cost one billed read per entry on every message.
+SEMANTIC_CACHE_THRESHOLD = 0.95
+SEMANTIC_CACHE_SIZE = 50
+semantic_cache = TTLCache(maxsize=1024, ttl=60 * 60)
+semantic_cache_lock = threading.Lock()
+
+def embed_message(message_text):
+    configure_gemini()
+    try:
+        result = genai.embed_content(
+            model=EMBEDDING_MODEL_NAME,
+            content=message_text,
+            task_type='semantic_similarity'
+        )
+    except Exception as e:
+        print(f"Error embedding message: {e}")
+        return None
+    embedding = result['embedding']
+    norm = math.sqrt(sum(x * x for x in embedding))
+    if not norm:
+        return None
+    return [x / norm for x in embedding]
+
+def find_cached_response(room_code, user_id, embedding):
+    with semantic_cache_lock:
+        entries = list(semantic_cache.get((room_code, user_id), ()))
+    if not entries:
+        return None
+
+    # Vectors are unit length, so the dot product is the cosine similarity.
+    similarity, parsed_data = max(
+        ((sum(a * b for a, b in zip(vector, embedding)), data) for vector, data in entries),
+        key=lambda entry: entry[0]
+    )
+    if similarity < SEMANTIC_CACHE_THRESHOLD:
+        return None
+    return {**parsed_data, 'affection_change': 0}
+
+def store_cached_response(room_code, user_id, embedding, parsed_data):
+    key = (room_code, user_id)
+    with semantic_cache_lock:
+        entries = semantic_cache.get(key)
+        if entries is None:
+            entries = deque(maxlen=SEMANTIC_CACHE_SIZE)
+        entries.append((embedding, parsed_data))
+        semantic_cache[key] = entries
+
+# --- Chat turn helpers ---
+def format_sse(event, data):
+    return f"event: {event}\ndata: {orjson.dumps(data).decode()}\n\n"
+
+# Scores are read and written inside a transaction so two players sending
+# at once can't overwrite each other's change with a stale snapshot. The
+# turn's messages depend on the final score and are committed with it.
+@firestore.transactional
+def apply_affection_change(transaction, room_ref, user_id, affection_change, build_messages):
+    score_path = f'users.{user_id}.score'
+    snapshot = room_ref.get(field_paths=[score_path, 'game_over'], transaction=transaction)
+
+    new_score = max(0, min(100, snapshot.get(score_path) + affection_change))
+    update_data = {score_path: new_score}
+
+    has_won = new_score >= 100 and not snapshot.get('game_over')
+    if has_won:
+        update_data['game_over'] = True
+
+    transaction.update(room_ref, update_data)
+    queue_messages(transaction, room_ref, build_messages(new_score, has_won))
+
+def save_chat_turn(room_code, room_data, user_id, nickname, message_text, parsed_data,
+                   py_timestamp_start, is_cached=False):
+    room_ref = get_db().collection('rooms').document(room_code)
+    bot_response = parsed_data['response']
+    affection_change = parsed_data['affection_change']
+
+    py_timestamp_end = datetime.utcnow().replace(tzinfo=timezone.utc)
+
+    def build_messages(new_score, has_won):
+        score_msg = f"{nickname}'s affection didn't change. (Still {new_score}%)"
+        if affection_change > 0:
+            score_msg = f"{nickname}'s affection went up by {affection_change}%! (Now {new_score}%)"
+        elif affection_change < 0:
+            score_msg = f"{nickname}'s affection went down by {abs(affection_change)}%! (Now {new_score}%)"
+
+        messages_to_add = [
+            {'user': user_id, 'text': message_text, 'timestamp': py_timestamp_start},
+            {'user': room_data['bot_name'], 'text': bot_response, 'timestamp': py_timestamp_end, 'cached': is_cached},
+            {'user': 'System', 'text': score_msg, 'timestamp': py_timestamp_end}
+        ]
+
+        if has_won:
+            messages_to_add.append({
+                'user': 'System',
+                'text': f"GAME OVER! {nickname} has won {room_data['bot_name']}'s affection!",
+                'timestamp': py_timestamp_end
+            })
+        return messages_to_add
+
+    apply_affection_change(get_db().transaction(), room_ref, user_id, affection_change, build_messages)
+    invalidate_room(room_code)
+
+def record_chat_error(room_ref, user_id, nickname, message_text, e):
+    print(f"Error during Gemini call: {e}")
+    py_timestamp_error = datetime.utcnow().replace(tzinfo=timezone.utc)
+    add_messages(room_ref, [
+        {'user': user_id, 'text': message_text, 'timestamp': py_timestamp_error},
+        {'user': 'System', 'text': f"Sorry, {nickname}, I'm having trouble thinking. (Error: {e})", 'timestamp': py_timestamp_error}
+    ])
+
 # --- index route (Unchanged) ---
 @app.route("/")
 def index():
     return render_template("index.html")
 
-# --- /generate-bot-image (Unchanged) ---
+# --- Bot image generation (background task) ---
+# Stability + Cloudinary take 10-30s, so the route only enqueues the work and
+# the browser polls /job/<job_id>. Job state lives in Firestore so it is
+# visible whichever worker runs the task.
+def update_image_job(job_id, **fields):
+    get_db().collection('image_jobs').document(job_id).update(fields)
+
+# Returns the JSON body and status code for the generated image.
+def generate_bot_image_result(gender, age, appearance):
+    prompt = f"A beautiful portrait of a {age} year old {gender}, {appearance}. digital art, anime style, detailed face, cinematic lighting, high quality"
+    negative_prompt = "blurry, deformed, ugly, bad anatomy, mutated, extra limbs, disfigured"
+    
+    print(f"Stability Prompt: {prompt}")
+
+    answers = get_stability_api().generate(
+        prompt=[
+            generation.Prompt(text=prompt, parameters=generation.PromptParameters(weight=1.0)),
+            generation.Prompt(text=negative_prompt, parameters=generation.PromptParameters(weight=-1.0))
+        ],
+        style_preset="anime",
+        steps=30,
+        cfg_scale=7.0,
+        width=512,
+        height=512,
+        samples=1
+    )
+
+    for resp in answers:
+        for artifact in resp.artifacts:
+            if artifact.finish_reason == generation.FILTER:
+                return {'success': False, 'error': 'Image generation was filtered for safety. Try a different prompt.'}, 400
+            
+            if artifact.type == generation.ARTIFACT_IMAGE:
+                img_data = artifact.binary
+                
+                print("Uploading to Cloudinary...")
+                upload_result = cloudinary.uploader.upload(
+                    img_data,
+                    folder="bot_avatars",
+                    public_id=f"bot_{random_id()}"
+                )
+                
+                secure_url = upload_result.get('secure_url')
+                if not secure_url:
+                    return {'success': False, 'error': 'Failed to upload image to Cloudinary.'}, 500
+                
+                print(f"Image uploaded: {secure_url}")
+                return {'success': True, 'image_url': secure_url}, 200
+
+    return {'success': False, 'error': 'No image was generated.'}, 500
+
+if celery is not None:
+    @celery.task
+    def generate_bot_image_task(job_id, gender, age, appearance):
+        try:
+            result, _ = generate_bot_image_result(gender, age, appearance)
+        except Exception as e:
+            print(f"Error generating image: {e}")
+            result = {'success': False, 'error': str(e)}
+
+        if result['success']:
+            update_image_job(job_id, status='done', image_url=result['image_url'])
+        else:
+            update_image_job(job_id, status='failed', error=result['error'])
+
+# --- /generate-bot-image ---
 @app.route("/generate-bot-image", methods=["POST"])
 def generate_bot_image():
     try:
@@ -183,89 +571,65 @@ def generate_bot_image():
         age = data.get('age', '20')
         appearance = data.get('appearance', 'average')
 
-        prompt = f"A beautiful portrait of a {age} year old {gender}, {appearance}. digital art, anime style, detailed face, cinematic lighting, high quality"
-        negative_prompt = "blurry, deformed, ugly, bad anatomy, mutated, extra limbs, disfigured"
-        
-        print(f"Stability Prompt: {prompt}")
-
-        answers = stability_api.generate(
-            prompt=[
-                generation.Prompt(text=prompt, parameters=generation.PromptParameters(weight=1.0)),
-                generation.Prompt(text=negative_prompt, parameters=generation.PromptParameters(weight=-1.0))
-            ],
-            style_preset="anime",
-            steps=30,
-            cfg_scale=7.0,
-            width=512,
-            height=512,
-            samples=1
-        )
+        if celery is None:
+            result, status = generate_bot_image_result(gender, age, appearance)
+            return jsonify(result), status
 
-        for resp in answers:
-            for artifact in resp.artifacts:
-                if artifact.finish_reason == generation.FILTER:
-                    return jsonify({'success': False, 'error': 'Image generation was filtered for safety. Try a different prompt.'}), 400
-                
-                if artifact.type == generation.ARTIFACT_IMAGE:
-                    img_data = artifact.binary
-                    
-                    print("Uploading to Cloudinary...")
-                    upload_result = cloudinary.uploader.upload(
-                        img_data,
-                        folder="bot_avatars",
-                        public_id=f"bot_{generate_room_code(10)}"
-                    )
-                    
-                    secure_url = upload_result.get('secure_url')
-                    if not secure_url:
-                        return jsonify({'success': False, 'error': 'Failed to upload image to Cloudinary.'}), 500
-                    
-                    print(f"Image uploaded: {secure_url}")
-                    return jsonify({'success': True, 'image_url': secure_url})
-
-        return jsonify({'success': False, 'error': 'No image was generated.'}), 500
+        job_ref = get_db().collection('image_jobs').document()
+        job_ref.set({
+            'status': 'pending',
+            'created_at': datetime.utcnow().replace(tzinfo=timezone.utc)
+        })
+        generate_bot_image_task.apply_async(args=[job_ref.id, gender, age, appearance], task_id=job_ref.id)
+
+        return jsonify({'success': True, 'job_id': job_ref.id}), 202
 
     except Exception as e:
         print(f"Error generating image: {e}")
         return jsonify({'success': False, 'error': str(e)}), 500
 
-# --- /upload-bot-image (Unchanged) ---
-@app.route("/upload-bot-image", methods=["POST"])
-def upload_bot_image():
-    if 'file' not in request.files:
-        return jsonify({'success': False, 'error': 'No file part'}), 400
-    
-    file = request.files['file']
-    
-    if file.filename == '':
-        return jsonify({'success': False, 'error': 'No selected file'}), 400
-    
-    if file:
-        try:
-            print("Uploading custom image to Cloudinary...")
-            upload_result = cloudinary.uploader.upload(
-                file,
-                folder="bot_avatars",
-                public_id=f"bot_{generate_room_code(10)}"
-            )
-            secure_url = upload_result.get('secure_url')
-            if not secure_url:
-                return jsonify({'success': False, 'error': 'Failed to upload to Cloudinary.'}), 500
-            
-            print(f"Image uploaded: {secure_url}")
-            return jsonify({'success': True, 'image_url': secure_url})
-        
-        except Exception as e:
-            print(f"Error uploading image: {e}")
-            return jsonify({'success': False, 'error': str(e)}), 500
-
-    return jsonify({'success': False, 'error': 'Unknown file error'}), 500
+# --- /job/<job_id> ---
+@app.route("/job/<job_id>")
+def image_job_status(job_id):
+    job_doc = get_db().collection('image_jobs').document(job_id).get()
+    if not job_doc.exists:
+        return jsonify({'success': False, 'error': 'Job not found'}), 404
+
+    job_data = job_doc.to_dict()
+    return jsonify({
+        'success': job_data['status'] != 'failed',
+        'status': job_data['status'],
+        'image_url': job_data.get('image_url'),
+        'error': job_data.get('error')
+    })
+
+# --- /cloudinary-signature ---
+# Custom images go straight from the browser to Cloudinary; the server only
+# signs the upload parameters so the file never passes through this worker.
+# allowed_formats is part of the signature, so the same signature can't be
+# replayed against /raw/upload or /video/upload for anything but an image.
+@app.route("/cloudinary-signature", methods=["POST"])
+def cloudinary_signature():
+    config = cloudinary.config()
+    upload_params = {
+        'timestamp': int(datetime.now(timezone.utc).timestamp()),
+        'folder': "bot_avatars",
+        'public_id': f"bot_{random_id()}",
+        'allowed_formats': "jpg,png,webp"
+    }
+    signature = cloudinary.utils.api_sign_request(upload_params, config.api_secret)
+    return jsonify({
+        'success': True,
+        'signature': signature,
+        'api_key': config.api_key,
+        'cloud_name': config.cloud_name,
+        **upload_params
+    })
 
 # --- create_room (THIS IS THE FIX) ---
 @app.route("/create", methods=["GET", "POST"])
 def create_room():
     if request.method == "POST":
-        room_code = generate_room_code()
         user_id = get_user_id()
         
         nickname = request.form.get('nickname', 'Host')
@@ -292,8 +656,22 @@ def create_room():
             'users': {
                 user_id: {'nickname': nickname, 'score': 0}
             },
-            'messages': [
-                 {
+            'bot_image_url': bot_image_url,
+            'bot_appearance': bot_appearance
+        }
+        # --- END OF FIX ---
+
+        new_room_data['static_prompt'] = build_system_prompt(new_room_data)
+        gemini_cache = create_gemini_cache(new_room_data['static_prompt'])
+        new_room_data['gemini_cache_name'] = gemini_cache.name if gemini_cache else None
+        
+        while True:
+            room_code = generate_room_code()
+            room_ref = get_db().collection('rooms').document(room_code)
+            batch = get_db().batch()
+            batch.create(room_ref, new_room_data)
+            queue_messages(batch, room_ref, [
+                {
                     'user': 'System', 
                     'text': f"Game started! {nickname} created the room.",
                     'timestamp': py_timestamp 
@@ -303,13 +681,12 @@ def create_room():
                     'text': start_scenario,
                     'timestamp': py_timestamp 
                 }
-            ],
-            'bot_image_url': bot_image_url,
-            'bot_appearance': bot_appearance
-        }
-        # --- END OF FIX ---
-        
-        db.collection('rooms').document(room_code).set(new_room_data)
+            ])
+            try:
+                batch.commit()
+                break
+            except google_exceptions.AlreadyExists:
+                print(f"Room code {room_code} already taken, retrying.")
         
         return redirect(url_for('chat_room', room_code=room_code))
     
@@ -317,20 +694,17 @@ def create_room():
 
 # --- join_room (Unchanged) ---
 @app.route("/join", methods=["POST"])
-def join_room():
-    room_code = request.form.get('room_code')
+async def join_room():
+    room_code = request.form.get('room_code', '').strip().upper()
     nickname = request.form.get('nickname', 'Guest')
     if not nickname.strip():
         nickname = f"Guest_{random.randint(100, 999)}"
     
-    room_ref = db.collection('rooms').document(room_code)
-    room_doc = room_ref.get()
+    room_data = await asyncio.to_thread(get_room, room_code)
 
-    if not room_doc.exists:
+    if room_data is None:
         flash("Error: Room code not found.")
         return redirect(url_for('index'))
-    
-    room_data = room_doc.to_dict()
         
     if room_data.get('game_over', False):
         flash("Error: This game has already ended.")
@@ -338,43 +712,57 @@ def join_room():
         
     user_id = get_user_id()
     session['nickname'] = nickname
+
+    if user_id not in room_data['users']:
+        # Another instance may have added us since this copy was cached.
+        room_data = await asyncio.to_thread(get_room, room_code, True)
     
     if user_id not in room_data['users']:
         
         py_timestamp = datetime.utcnow().replace(tzinfo=timezone.utc)
         
-        room_ref.update({
-            f'users.{user_id}': {'nickname': nickname, 'score': 0},
-            'messages': firestore.ArrayUnion([
-                {
-                    'user': 'System',
-                    'text': f"{nickname} has joined the game!",
-                    'timestamp': py_timestamp 
-                }
-            ])
+        room_ref = get_db().collection('rooms').document(room_code)
+        batch = get_db().batch()
+        batch.update(room_ref, {
+            f'users.{user_id}': {'nickname': nickname, 'score': 0}
         })
+        queue_messages(batch, room_ref, [
+            {
+                'user': 'System',
+                'text': f"{nickname} has joined the game!",
+                'timestamp': py_timestamp 
+            }
+        ])
+        await asyncio.to_thread(batch.commit)
+        invalidate_room(room_code)
         
     return redirect(url_for('chat_room', room_code=room_code))
 
 # --- chat_room (Unchanged) ---
 @app.route("/room/<room_code>", methods=["GET", "POST"])
-def chat_room(room_code):
-    room_ref = db.collection('rooms').document(room_code)
-    room_doc = room_ref.get()
+async def chat_room(room_code):
+    room_ref = get_db().collection('rooms').document(room_code)
+    room_data = await asyncio.to_thread(get_room, room_code)
 
-    if not room_doc.exists:
+    if room_data is None:
         flash("Error: Room not found.")
         return redirect(url_for('index'))
         
     user_id = get_user_id()
     nickname = get_nickname()
-    room_data = room_doc.to_dict()
     
     if user_id not in room_data.get('users', {}):
+        # The join may have gone through another instance after we cached the room.
+        room_data = await asyncio.to_thread(get_room, room_code, True)
+
+    if room_data is None or user_id not in room_data.get('users', {}):
         flash("Error: You are not part of this room. Please join first.")
         return redirect(url_for('index'))
 
-    # Handle a new message submission
+    # Handle a new message submission. The room read above stays: the prompt
+    # needs every player's current score, and get_room serves it from the
+    # short-lived cache when this instance just rendered the page. The score
+    # itself is re-read inside the transaction so the 0-100 clamp is exact.
     if request.method == "POST":
         if room_data.get('game_over', False):
             return jsonify({'success': False, 'error': 'Game is over'}), 400
@@ -386,57 +774,65 @@ def chat_room(room_code):
         try:
             py_timestamp_start = datetime.utcnow().replace(tzinfo=timezone.utc)
 
-            prompt = build_gemini_prompt(room_data, nickname, message_text)
-            response = model.generate_content(prompt)
-            parsed_data = parse_gemini_response(response.text)
-            
-            bot_response = parsed_data['response']
-            affection_change = parsed_data['affection_change']
-
-            py_timestamp_end = datetime.utcnow().replace(tzinfo=timezone.utc)
-
-            user_data = room_data['users'][user_id]
-            new_score = user_data['score'] + affection_change
-            new_score = max(0, min(100, new_score))
-            
-            score_msg = f"{nickname}'s affection didn't change. (Still {new_score}%)"
-            if affection_change > 0:
-                score_msg = f"{nickname}'s affection went up by {affection_change}%! (Now {new_score}%)"
-            elif affection_change < 0:
-                score_msg = f"{nickname}'s affection went down by {abs(affection_change)}%! (Now {new_score}%)"
-
-            messages_to_add = [
-                {'user': user_id, 'text': message_text, 'timestamp': py_timestamp_start},
-                {'user': room_data['bot_name'], 'text': bot_response, 'timestamp': py_timestamp_end},
-                {'user': 'System', 'text': score_msg, 'timestamp': py_timestamp_end}
-            ]
-
-            update_data = {
-                f'users.{user_id}.score': new_score
-            }
-
-            if new_score >= 100:
-                update_data['game_over'] = True
-                messages_to_add.append({
-                    'user': 'System',
-                    'text': f"GAME OVER! {nickname} has won {room_data['bot_name']}'s affection!",
-                    'timestamp': py_timestamp_end
-                })
-            
-            update_data['messages'] = firestore.ArrayUnion(messages_to_add)
-            room_ref.update(update_data)
-            
-            return jsonify({'success': True})
+            canned_reply = prefilter_message(message_text)
+            if canned_reply is None:
+                recent_messages, chat_model = await asyncio.gather(
+                    asyncio.to_thread(get_recent_messages, room_ref, room_data),
+                    asyncio.to_thread(get_chat_model, room_code, room_data)
+                )
+                recent_user_texts = [msg['text'] for msg in recent_messages if msg['user'] == user_id]
+                canned_reply = check_repeated_message(message_text, recent_user_texts)
+
+            if canned_reply is not None:
+                await asyncio.to_thread(save_chat_turn, room_code, room_data, user_id, nickname,
+                                        message_text, canned_reply, py_timestamp_start)
+                return Response(format_sse('done', {'success': True, **canned_reply}),
+                                mimetype='text/event-stream')
+
+            prompt = build_gemini_prompt(room_data, recent_messages, nickname, message_text)
+
+            parsed_data = None
+            embedding = await asyncio.to_thread(embed_message, message_text)
+            if embedding is not None:
+                parsed_data = find_cached_response(room_code, user_id, embedding)
+
+            if parsed_data is not None:
+                print(f"Semantic cache hit in room {room_code} (cached)")
+                await asyncio.to_thread(save_chat_turn, room_code, room_data, user_id, nickname,
+                                        message_text, parsed_data, py_timestamp_start, is_cached=True)
+                return Response(format_sse('done', {'success': True, **parsed_data}),
+                                mimetype='text/event-stream')
 
         except Exception as e:
-            print(f"Error during Gemini call: {e}")
-            py_timestamp_error = datetime.utcnow().replace(tzinfo=timezone.utc)
-            room_ref.update({
-                'messages': firestore.ArrayUnion([
-                    {'user': user_id, 'text': message_text, 'timestamp': py_timestamp_error},
-                    {'user': 'System', 'text': f"Sorry, {nickname}, I'm having trouble thinking. (Error: {e})", 'timestamp': py_timestamp_error}
-                ])
-            })
+            await asyncio.to_thread(record_chat_error, room_ref, user_id, nickname, message_text, e)
             return jsonify({'success': False, 'error': str(e)}), 500
 
+        # Forward Gemini's output as it arrives; the score and Firestore writes
+        # can only happen once the whole JSON reply is in.
+        def stream_reply():
+            try:
+                chunks = []
+                response = chat_model.generate_content(prompt, stream=True,
+                                                       generation_config=GEMINI_GENERATION_CONFIG)
+                for chunk in response:
+                    chunks.append(chunk.text)
+                    yield format_sse('token', {'text': chunk.text})
+
+                parsed_data = parse_gemini_response("".join(chunks))
+                if embedding is not None:
+                    store_cached_response(room_code, user_id, embedding, parsed_data)
+                save_chat_turn(room_code, room_data, user_id, nickname, message_text,
+                               parsed_data, py_timestamp_start)
+                yield format_sse('done', {'success': True, **parsed_data})
+
+            except Exception as e:
+                if isinstance(e, google_exceptions.NotFound):
+                    # The Gemini cache behind this room's model is gone; rebuild next turn.
+                    evict_chat_model(room_code)
+                record_chat_error(room_ref, user_id, nickname, message_text, e)
+                yield format_sse('error', {'success': False, 'error': str(e)})
+
+        return Response(stream_with_context(stream_reply()), mimetype='text/event-stream',
+                        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
     return render_template("room.html", room=room_data, room_code=room_code, user_id=user_id)